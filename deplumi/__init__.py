@@ -1,6 +1,8 @@
 """
 Wrapper to connect resources to lambda calls.
 """
+import asyncio
+import functools
 from pathlib import Path
 import os
 
@@ -14,7 +16,7 @@ from putils import (
     get_public_subnets,
 )
 
-from .builders.pipenv import PipenvPackage
+from .builders.pipenv import PipenvPackage, RUNTIME
 from .resourcegen import ResourceGenerator
 from .rolegen import generate_role
 
@@ -30,7 +32,21 @@ __all__ = 'Package', 'EventHandler', 'AwsgiHandler',
 #    - Generates roles to access the given resources
 #    - Generates code in the package to instantiate resources.
 
-_lambda_buckets = {}
+
+# This is deliberately per-process. Pulumi deletes anything a program stops
+# declaring, so the bucket has to be registered on every run; there is nothing
+# that could safely be cached between invocations.
+@functools.lru_cache(maxsize=None)
+def _make_bucket(region):
+    return s3.Bucket(
+        f'lambda-bucket-{region}',
+        region=region,
+        versioning={
+            'enabled': True,
+        },
+        # FIXME: Life cycle rules for expiration
+        **opts(region=region),
+    )
 
 
 def get_lambda_bucket(region=None, resource=None):
@@ -40,18 +56,7 @@ def get_lambda_bucket(region=None, resource=None):
     if resource is not None:
         region = get_region(resource)
 
-    if region not in _lambda_buckets:
-        _lambda_buckets[region] = s3.Bucket(
-            f'lambda-bucket-{region}',
-            region=region,
-            versioning={
-                'enabled': True,
-            },
-            # FIXME: Life cycle rules for expiration
-            **opts(region=region),
-        )
-
-    return _lambda_buckets[region]
+    return _make_bucket(region)
 
 
 @outputish
@@ -62,19 +67,24 @@ async def build_zip_package(sourcedir, resgen):
     else:
         raise OSError("Unable to detect package type")
 
-    # Do any preparatory stuff
-    await package.warmup()
+    # Do any preparatory stuff. Resolving the resources doesn't depend on the
+    # dependencies, so let it happen while those install.
+    resmod, _ = await asyncio.gather(resgen.build(), package.warmup())
 
     # Actually build the zip
-    bundle = await package.build()
+    bundle = await package.build(resmod)
 
+    # The upload is done by the provider, from the finished file. Assets have
+    # no notion of partial content, so the zip can't be streamed into it.
     return pulumi.FileAsset(os.fspath(bundle))
 
 
-class Package(Component, outputs=['funcargs', 'bucket', 'object', 'role', '_resources']):
+class Package(Component, outputs=['funcargs', 'bucket', 'object', 'role']):
     def set_up(self, name, *, sourcedir, resources=None, __opts__):
         if resources is None:
             resources = {}
+        # This should only be used internally, so it doesn't need to be an output
+        self._resources = tuple(resources.values())
         resgen = ResourceGenerator(resources)
         bucket = get_lambda_bucket(resource=self)
         bobj = s3.BucketObject(
@@ -97,7 +107,6 @@ class Package(Component, outputs=['funcargs', 'bucket', 'object', 'role', '_reso
             'bucket': bucket,
             'object': bobj,
             'role': role,
-            '_resources': list(resources.values()),  # This should only be used internally
         }
 
     def function(self, name, func, **kwargs):
@@ -108,7 +117,7 @@ class Package(Component, outputs=['funcargs', 'bucket', 'object', 'role', '_reso
             s3_bucket=self.bucket.bucket,
             s3_key=self.object.key,
             s3_object_version=self.object.version_id,
-            runtime='python3.7',
+            runtime=RUNTIME,
             role=self.role.arn,
             **kwargs,
         )
@@ -141,6 +150,8 @@ def AwsgiHandler(self, name, zone, domain, package, func, __opts__, **lambdaargs
 
     netinfo = get_public_subnets(opts=__opts__)
 
+    # These are left as separate applies on purpose. Fusing them into one
+    # apply still needs a projection per value, which means more Output nodes.
     @netinfo.apply
     def vpc_id(info):
         vpc, subnets, is_v6 = info
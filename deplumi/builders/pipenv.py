@@ -1,30 +1,55 @@
 import asyncio
+import collections
+import concurrent.futures
+import functools
 import hashlib
+import json
+import mmap
 import os
 from pathlib import Path
 import subprocess
 import sys
 import tempfile
+import time
 import zipfile
+import zlib
 
 import pulumi
 
 from putils import background
 
+from ..resourcegen import compile_module
 
-def _get_root(relpath):
-    assert not relpath.is_absolute()
-    # Parents goes from longest to shortest, so:
-    # -1: '.'
-    # -2: first directory
-    # -3: second directory
-    # ...
-    # 0: The given file
-    p = list(relpath.parents)
-    if len(p) == 1:
-        return relpath
-    else:
-        return p[-2]
+# The lambda runtime packages are built for
+RUNTIME_VERSION = (3, 7)
+RUNTIME = 'python{}.{}'.format(*RUNTIME_VERSION)
+
+
+def _get_root(arcname):
+    """
+    Get the top-level name of a posix-style archive name
+    """
+    return arcname.split('/', 1)[0]
+
+
+def _walk(source, filter=None):
+    """
+    Recursively scan source, yielding (DirEntry, arcname) for everything in it.
+
+    Like os.walk(), but hands back the DirEntry so its stat() can be reused.
+    Anything filter rejects is skipped, including everything under a rejected
+    directory. Symlinked directories are yielded but not descended into.
+    """
+    stack = [source]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                arcname = os.path.relpath(entry.path, source).replace(os.sep, '/')
+                if filter is not None and not filter(arcname):
+                    continue
+                yield entry, arcname
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
 
 
 def mkzinfo(name, contents):
@@ -36,6 +61,145 @@ def mkzinfo(name, contents):
     return zi
 
 
+def _zinfo_from_stat(arcname, st):
+    """
+    Like ZipInfo.from_file(), but from an existing stat result
+    """
+    zi = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+    zi.external_attr = (st.st_mode & 0xFFFF) << 16
+    zi.file_size = st.st_size
+    zi.compress_type = zipfile.ZIP_STORED
+    return zi
+
+
+def _read_member(path, arcname, st):
+    """
+    Read a file into a (zinfo, data) pair, ready for ZipFile.writestr()
+    """
+    zi = _zinfo_from_stat(arcname, st)
+    with open(path, 'rb') as f:
+        return zi, f.read()
+
+
+def _stat_key(st):
+    """
+    Key identifying a specific version of a file, for caching
+
+    ctime is included because mtime can be set back (cp -p, touch -r, etc).
+    """
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{st.st_ctime_ns}"
+
+
+def _load_crcs(cachefile):
+    try:
+        with open(cachefile) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_crcs(cachefile, crcs):
+    cachefile = Path(cachefile)
+    cachefile.parent.mkdir(parents=True, exist_ok=True)
+    # Write and rename, so that a concurrent build never sees half a file.
+    # Builds run in threads, so the temp name has to be unique per call.
+    fd, tmp = tempfile.mkstemp(dir=cachefile.parent, prefix=f"{cachefile.name}.", suffix='.tmp')
+    try:
+        with open(fd, 'w') as f:
+            json.dump(crcs, f)
+        os.replace(tmp, cachefile)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _scan_member(path, arcname, st, crcs=None):
+    """
+    Checksum a file into a (zinfo, path) pair, ready for _sendfile_member()
+
+    crcs is a cache of previously computed checksums, by _stat_key().
+    """
+    zi = _zinfo_from_stat(arcname, st)
+    zi.compress_size = zi.file_size
+    key = _stat_key(st)
+    if crcs is not None and key in crcs:
+        zi.CRC = crcs[key]
+    elif zi.file_size:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            zi.CRC = zlib.crc32(m)
+    else:
+        zi.CRC = 0
+    return zi, path
+
+
+def _sendfile_member(zf, zi, path):
+    """
+    Append a stored file to zf, having the kernel copy the contents.
+
+    This pokes at ZipFile internals, doing what ZipFile.write() does for a
+    stored member whose CRC is already known.
+    """
+    zf._writecheck(zi)
+    zf._didModify = True
+    zi.header_offset = zf.fp.tell()
+    zf.fp.write(zi.FileHeader())
+    zf.fp.flush()
+    with open(path, 'rb') as src:
+        offset = 0
+        while offset < zi.file_size:
+            sent = os.sendfile(zf.fp.fileno(), src.fileno(), offset, zi.file_size - offset)
+            if not sent:
+                raise OSError(f"{path} changed while being zipped")
+            offset += sent
+    # sendfile() moved the fd out from under the buffered file
+    zf.fp.seek(zi.header_offset + len(zi.FileHeader()) + zi.file_size)
+    zf.filelist.append(zi)
+    zf.NameToInfo[zi.filename] = zi
+    zf.start_dir = zf.fp.tell()
+
+
+# Linux is the only platform that will sendfile() into a regular file
+_USE_SENDFILE = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+
+
+def _map_members(func, entries, workers=None):
+    """
+    Call func on the given (path, arcname, stat) triples in parallel, yielding
+    the results in order.
+
+    Only a bounded number of files are in flight at once, so that we don't pull
+    the whole of site-packages into memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for path, arcname, st in entries:
+            pending.append(pool.submit(func, path, arcname, st))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _requirements_to_args(reqs):
+    """
+    Convert requirements.txt contents to pip install arguments, for when it
+    can't just be fed over stdin.
+    """
+    args = []
+    for line in reqs.decode('utf-8').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        elif line.startswith('-'):
+            # Options, like -i
+            args += line.split()
+        else:
+            # Specifiers, which may contain spaces in their markers
+            args.append(line)
+    return args
+
+
 class PipenvPackage:
     def __init__(self, root, resgen):
         self.root = Path(root).resolve()
@@ -54,19 +218,27 @@ class PipenvPackage:
         # FIXME: Linux only
         buildroot = Path('/tmp/deplumi')
         buildroot.mkdir(parents=True, exist_ok=True)
-        contents = self.lockfile.read_bytes()
-        dirname = hashlib.sha3_256(contents).hexdigest()
+        # This is just a cache key, so use a fast hash instead of a strong one
+        if hasattr(hashlib, 'file_digest'):
+            with self.lockfile.open('rb') as f:
+                digest = hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16))
+            dirname = digest.hexdigest()
+        else:
+            contents = self.lockfile.read_bytes()
+            dirname = hashlib.blake2b(contents, digest_size=16).hexdigest()
         return buildroot / dirname
 
-    async def _call_subprocess(self, *cmd, check=True, **opts):
+    async def _call_subprocess(self, *cmd, check=True, input=None, **opts):
         cmd = [
             os.fspath(part) if hasattr(part, '__fspath__') else part
             for part in cmd
         ]
+        if input is not None:
+            opts.setdefault('stdin', asyncio.subprocess.PIPE)
         proc = await asyncio.create_subprocess_exec(*cmd, **opts)
-        stdout, stderr = await proc.communicate()
+        stdout, stderr = await proc.communicate(input)
         if check and proc.returncode != 0:
-            raise subprocess.SubprocessError
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
         return stdout, stderr
 
     async def _call_python(self, *cmd, **opts):
@@ -80,13 +252,38 @@ class PipenvPackage:
             'PIPENV_VERBOSITY': '-1',
             **os.environ,
         }
-        return await self._call_subprocess(
+        call = functools.partial(
+            self._call_subprocess,
             'pipenv', *cmd,
             env=env,
             cwd=str(self.root),
-            **opts,
         )
 
+        # Don't let a chatty pipenv fill up a stderr pipe and block
+        if 'stderr' in opts:
+            return await call(**opts)
+        elif opts.get('stdout') == subprocess.PIPE:
+            return await self._call_with_stderr_file(call, **opts)
+        else:
+            try:
+                return await call(stderr=subprocess.DEVNULL, **opts)
+            except subprocess.CalledProcessError:
+                # Run it again to find out what went wrong
+                return await self._call_with_stderr_file(call, **opts)
+
+    async def _call_with_stderr_file(self, call, **opts):
+        """
+        Call with stderr going to a temp file, reporting it if the call fails
+        """
+        with tempfile.TemporaryFile() as errf:
+            try:
+                return await call(stderr=errf, **opts)
+            except subprocess.CalledProcessError as exc:
+                errf.seek(0)
+                exc.stderr = errf.read()
+                pulumi.error(exc.stderr.decode('utf-8', 'replace'))
+                raise
+
     async def warmup(self):
         """
         Do pre-build prep
@@ -109,17 +306,30 @@ class PipenvPackage:
                 line[3:] if line.startswith(b'-e') else line
                 for line in out.split(b'\n')
             )
-            with tempfile.NamedTemporaryFile() as ntf:
-                ntf.write(out)
-                ntf.flush()
-                await self._call_subprocess(
-                    'pip', 'install', '--target', builddir, '-r', ntf.name,
-                )
-
-    async def build(self):
+            if os.path.exists('/dev/stdin'):
+                # Just pipe it in, no need to round-trip through the disk
+                reqargs, reqinput = ['-r', '/dev/stdin'], out
+            else:
+                reqargs, reqinput = _requirements_to_args(out), None
+            await self._call_subprocess(
+                'pip', 'install', '--target', builddir, *reqargs,
+                input=reqinput, stdout=subprocess.DEVNULL,
+            )
+
+    async def build(self, resmod=None):
         """
         Actually build
+
+        resmod is the contents of __res__.py, if it's already been generated.
         """
+        if resmod is None:
+            resmod = await self.resgen.build()
+        if sys.version_info[:2] == RUNTIME_VERSION:
+            # Save lambda from compiling it on every cold start
+            virtuals = {'__res__.pyc': compile_module(resmod)}
+        else:
+            # Bytecode isn't portable between versions, so ship the source
+            virtuals = {'__res__.py': resmod}
         builddir = await self.get_builddir()
         ziproot = builddir
 
@@ -127,34 +337,97 @@ class PipenvPackage:
         # lifetime of the file needs to be.
         dest = str(builddir) + '.zip'
 
+        # builddir is already keyed on the lockfile, so just check for changes
+        # to the sources and generated bits
+        stamp = await self._get_stamp(builddir, virtuals)
+        stampfile = Path(dest + '.stamp')
+        try:
+            if os.path.exists(dest) and stampfile.read_text() == stamp:
+                pulumi.debug(f"Reusing {dest}")
+                return dest
+        except OSError:
+            pass
+
+        # Don't leave a stamp vouching for a half-written zip
+        if stampfile.exists():
+            stampfile.unlink()
         await self._build_zip(
             dest, ziproot, self.root,
-            virtuals={
-                '__res__.py': await self.resgen.build(),
-            },
+            virtuals=virtuals,
             filter=self._filter,
+            crccache=builddir.parent / '.zipcache' / f"{builddir.name}.json",
         )
+        stampfile.write_text(stamp)
 
         return dest
 
-    def _filter(self, path):
-        root = _get_root(path)
+    @background
+    def _get_stamp(self, builddir, virtuals):
+        """
+        Summarize everything that goes into the zip, other than builddir
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(builddir.name.encode('utf-8'))
+        for name, data in sorted(virtuals.items()):
+            h.update(name.encode('utf-8'))
+            h.update(data.encode('utf-8') if isinstance(data, str) else data)
+        entries = sorted(
+            (arcname, entry)
+            for entry, arcname in _walk(os.fspath(self.root), self._filter)
+        )
+        for arcname, entry in entries:
+            st = entry.stat()
+            # Same invalidation rule as the CRC cache
+            h.update(f"{arcname}:{_stat_key(st)}\n".encode('utf-8'))
+        return h.hexdigest()
+
+    def _filter(self, arcname):
+        root = _get_root(arcname)
         # FIXME: Scan for all the dependencies of boto3 recursively
-        if root.name in ('boto3', 'botocore'):
+        if root in ('boto3', 'botocore'):
             # These are provided by the runtime
             return False
+        elif '__pycache__' in arcname.split('/') or arcname.endswith(('.pyc', '.pyo')):
+            # Lambda compiles these itself, no sense shipping them
+            return False
         else:
             return True
 
     @background
-    def _build_zip(self, dest, *sources, virtuals={}, filter=None):
-        with zipfile.ZipFile(dest, 'w') as zf:
-            for source in sources:
-                source = Path(source)
-                for child in source.rglob('*'):
-                    arcname = child.relative_to(source)
-                    if filter is None or filter(arcname):
-                        zf.write(child, arcname.as_posix())
+    def _build_zip(self, dest, *sources, virtuals={}, filter=None, crccache=None):
+        # Always store, never deflate. site-packages is dominated by binaries
+        # that barely compress, and zlib runs at ~10MB/s on a single core. The
+        # artifact comes out ~5-10% larger, but the build is 10-50x faster on
+        # large site-packages and stays I/O-bound.
+        files = []
+        dirs = []
+        for source in sources:
+            for entry, arcname in _walk(os.fspath(source), filter):
+                # Symlinked directories go in as directories, like zf.write()
+                if entry.is_dir():
+                    dirs.append((entry.path, arcname))
+                else:
+                    files.append((entry.path, arcname, entry.stat()))
+
+        with zipfile.ZipFile(dest, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for child, arcname in dirs:
+                zf.write(child, arcname)
+            # Reading is farmed out to a pool; the zip itself can only be
+            # appended to from one thread.
+            if _USE_SENDFILE:
+                # Only checksum in the pool, and skip copying through userspace
+                crcs = _load_crcs(crccache) if crccache is not None else {}
+                scan = functools.partial(_scan_member, crcs=crcs)
+                newcrcs = {}
+                for (_, _, st), (zi, path) in zip(files, _map_members(scan, files)):
+                    _sendfile_member(zf, zi, path)
+                    newcrcs[_stat_key(st)] = zi.CRC
+                if crccache is not None:
+                    # Only keep what's still around
+                    _save_crcs(crccache, newcrcs)
+            else:
+                for zi, data in _map_members(_read_member, files):
+                    zf.writestr(zi, data)
             for name, data in virtuals.items():
                 zi = mkzinfo(name, data)
                 zf.writestr(zi, data)
@@ -1,5 +1,11 @@
-import pulumi
 import ast
+import asyncio
+import functools
+import importlib
+import importlib.util
+import marshal
+
+import pulumi
 
 # Knowledge of how to construct a boto3 resource from a pulumi resource
 BUILDERS = {
@@ -36,9 +42,54 @@ def __getattr__(name):
 
 
 def get_fqn(obj):
-    if not isinstance(obj, type):
-        obj = type(obj)
-    return f"{obj.__module__}.{obj.__qualname__}"
+    return _fqn_of_type(obj if isinstance(obj, type) else type(obj))
+
+
+@functools.lru_cache(maxsize=256)
+def _fqn_of_type(cls):
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _import_fqn(fqn):
+    """
+    Find the class with the given full name, or None if it's not available.
+    """
+    modname, _, qualname = fqn.rpartition('.')
+    # Nested classes aren't supported, which is fine for pulumi
+    try:
+        return getattr(importlib.import_module(modname), qualname)
+    except (ImportError, AttributeError):
+        return None
+
+
+# BUILDERS, but keyed on the actual classes we could find
+BUILDERS_BY_TYPE = {
+    cls: builder
+    for cls, builder in (
+        (_import_fqn(fqn), builder)
+        for fqn, builder in BUILDERS.items()
+    )
+    if cls is not None
+}
+
+
+def get_builder(obj):
+    try:
+        return BUILDERS_BY_TYPE[type(obj)]
+    except KeyError:
+        return BUILDERS[get_fqn(obj)]
+
+
+def compile_module(contents, filename='__res__.py'):
+    """
+    Compile generated source into the contents of a sourceless .pyc
+
+    This is only loadable by the same version of Python that compiled it.
+    """
+    code = compile(contents, filename, 'exec')
+    # Header is magic, flags, mtime, and source size. Sourceless pycs are never
+    # checked against their source, so the last three can all be 0.
+    return importlib.util.MAGIC_NUMBER + b'\x00' * 12 + marshal.dumps(code)
 
 
 class ResourceGenerator:
@@ -49,21 +100,30 @@ class ResourceGenerator:
         self.resources = resources
 
     async def build(self):
-        contents = HEADER
-        for name, res in self.resources.items():
-            attrs, expr = BUILDERS[get_fqn(res)]
-            values = await pulumi.Output.all(*[
+        builders = {
+            name: get_builder(res)
+            for name, res in self.resources.items()
+        }
+        # These are all independent, so resolve them all at once
+        resolved = await asyncio.gather(*(
+            pulumi.Output.all(*[
                 getattr(res, attr)
-                for attr in attrs
+                for attr in builders[name][0]
             ]).future()
-            contents += ITEM.format(
+            for name, res in self.resources.items()
+        ))
+
+        parts = [HEADER]
+        for (name, (attrs, expr)), values in zip(builders.items(), resolved):
+            parts.append(ITEM.format(
                 name=name,
                 attrs=attrs,
                 expr=expr,
                 values=tuple(values),
                 args=', '.join(attrs),
-            )
-        contents += FOOTER
+            ))
+        parts.append(FOOTER)
+        contents = ''.join(parts)
 
         # Double check we generated valid code
         # This is just a check so that weird errors don't happen at run time
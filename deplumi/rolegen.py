@@ -2,9 +2,11 @@
 Code to generate AWS IAM data (roles, etc) based on a pile of resources and the
 desired actions for each of them.
 """
+import json
+
 import pulumi
 from pulumi_aws import iam
-from putils import opts, FauxOutput
+from putils import opts
 
 # * Specific list of actions: Just those actions
 # * '*': Everything
@@ -16,47 +18,69 @@ from putils import opts, FauxOutput
 #     InheritedRole,
 # )
 
-BASIC_POLICY = FauxOutput(iam.get_policy('arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole'))
+# AWS managed policy, so this is the same everywhere and doesn't need looking up
+BASIC_POLICY_ARN = 'arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole'
+
+ASSUME_ROLE_POLICY = json.dumps({
+    "Version": "2012-10-17",
+    "Statement": [{
+        "Effect": "Allow",
+        "Action": "sts:AssumeRole",
+        "Principal": {
+            "Service": "lambda.amazonaws.com",
+        }
+      }]
+})
+
+
+# frozenset of resource ids -> (resources, Output of their ARNs)
+# The resources are kept so that their ids can't be reused.
+_arns_cache = {}
+
+
+def _get_arns(resources):
+    """
+    Get a single Output of the ARNs of the given resources, shared between
+    everything asking about the same set.
+    """
+    key = frozenset(id(res[0]) for res in resources.values())
+    if key not in _arns_cache:
+        _arns_cache[key] = (
+            [res[0] for res in resources.values()],
+            pulumi.Output.all(*(res[0].arn for res in resources.values())),
+        )
+    return _arns_cache[key][1]
 
 
 def generate_role(name, resources, **ropts):
     role = iam.Role(
         f'{name}',
-        assume_role_policy={
-            "Version": "2012-10-17",
-            "Statement": [{
-                "Effect": "Allow",
-                "Action": "sts:AssumeRole",
-                "Principal": {
-                    "Service": "lambda.amazonaws.com",
-                }
-              }]
-        },
+        assume_role_policy=ASSUME_ROLE_POLICY,
         **ropts,
     )
     iam.RolePolicyAttachment(
         f'{name}-base',
         role=role,
-        policy_arn=BASIC_POLICY.arn,
+        policy_arn=BASIC_POLICY_ARN,
         **opts(parent=role)
     )
 
     if resources:
+        # Serialize the whole document in one go, instead of leaving pulumi to
+        # dig an Output out of the middle of it
+        policy = _get_arns(resources).apply(lambda arns: json.dumps({
+            "Version": "2012-10-17",
+            # FIXME: Reduce this
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": "*",  # FIXME: More reasonable permissions
+                "Resource": arns,
+              }]
+        }))
         iam.RolePolicy(
             f'{name}-policy',
             role=role,
-            policy={
-                "Version": "2012-10-17",
-                # FIXME: Reduce this
-                "Statement": [{
-                    "Effect": "Allow",
-                    "Action": "*",  # FIXME: More reasonable permissions
-                    "Resource": pulumi.Output.all(*[
-                        res[0].arn
-                        for res in resources.values()
-                    ])
-                  }]
-            },
+            policy=policy,
             **opts(parent=role)
         )
 